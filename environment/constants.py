@@ -34,6 +34,8 @@ LOCATIONS = ['YOR', 'EDI', 'LON', 'LVP', 'NTH', 'WAL', 'CLY',
              'EAS', 'GRE', 'BUD', 'SER', 'ANK', 'SMY', 'SYR',
              'BUL', 'BUL/EC', 'CON', 'BUL/SC']
 
+LOC_TO_IX = {loc: ix for ix, loc in enumerate(LOCATIONS)}
+
 DAIDE_LOCATIONS = ['YOR', 'EDI', 'LON', 'LVP', 'NTH', 'WAL', 'CLY', 'NWG', 'ECH', 'IRI', 'NAO', 'BEL', 'DEN', 'HEL',
                    'HOL', 'NWY', 'SKA', 'BAR', 'BRE', 'MAO', 'PIC', 'BUR', 'RUH', 'BAL', 'KIE', 'SWE', 'FIN', 'STP',
                    '(STP NCS)', 'GAS', 'PAR', 'NAF', 'POR', 'SPA', '(SPA NCS)', '(SPA SCS)', 'WES', 'MAR', 'MUN', 'BER',
@@ -1,7 +1,8 @@
+from functools import lru_cache
+
 import numpy as np
 
 from diplomacy import Game
-from environment.action_list import ACTION_LIST
 from environment.constants import *
 from environment import order_utils
 
@@ -43,9 +44,11 @@ def get_season_code(state: dict) -> int:
         raise ValueError(f"Unknown season in state {state_name}")
 
 
+@lru_cache(maxsize=None)
 def get_loc_types():
     """
     Returns a dictionary with keys as location and values as the type of location (land, sea, coast)
+    The map never changes, so the dictionary is only built once and must not be modified
     :return: dictionary with location and its corresponding type
     """
     return {key.upper(): item for key, item in Game().map.loc_type.items()}
@@ -122,7 +125,7 @@ def get_dislodged_units_power_by_loc(state):
     return {retreats.split()[1]: power for power in state["retreats"] for retreats in state["retreats"][power]}
 
 
-def get_board_state(state):
+def get_board_state(state, out=None):
     """
     Given the state of a game, this function returns an array representing the state of the board.
     The array has dimensions (num_locs, loc_vector_length) and contains information about the unit type,
@@ -131,11 +134,16 @@ def get_board_state(state):
     Each location vector is composed of zeros
 
     :param state: current state of the game.
+    :param out: optional array of shape (num_locs, loc_vector_length) to write the board state into
     :return: an array of shape (num_locs, loc_vector_length) containing information about the state of the board.
     """
 
     # Initialize empty board state
-    board_state = []
+    if out is None:
+        board_state = np.zeros((len(LOCATIONS), LOC_VECTOR_LENGTH))
+    else:
+        board_state = out
+        board_state.fill(0)
 
     # Get information about the unit types, power influence, dislodged units, supply centers, and location types
     unit_type = get_unit_type_by_loc(state)
@@ -146,9 +154,9 @@ def get_board_state(state):
     loc_types = get_loc_types()
 
     # Iterate over each location on the board
-    for loc in LOCATIONS:
-        # Initialize empty location vector
-        loc_vector = np.zeros(LOC_VECTOR_LENGTH)
+    for loc_ix, loc in enumerate(LOCATIONS):
+        # Empty location vector, a view of its row in the board state
+        loc_vector = board_state[loc_ix]
 
         # Unit type
         if loc in unit_type:
@@ -193,45 +201,70 @@ def get_board_state(state):
             else:
                 loc_vector[CENTER_OWNER_INDEX + 7] = 1
 
-        # Append location vector to board state
-        board_state.append(loc_vector)
-
-        # Return board state as numpy array
-    return np.array(board_state)
+    return board_state
 
 
-def get_last_phase_orders(game: Game):
+def get_last_phase_orders(game: Game, out=None):
     """
     Given a game object, this function returns an array representing the orders of the last phase.
     The array has dimensions (num_locs, order_size)
     and contains information about the order issued on each location on the board.
 
     :param game: game object
+    :param out: optional array of shape (num_locs, order_size) to write the orders into
     :return: an array of shape (num_locs, order_size) containing information about the orders of the last phase.
     """
     phase_history = Game.get_phase_history(game, from_phase=-1)
     if phase_history:
-        return phase_orders_to_rep(phase_history[0].orders)
+        return phase_orders_to_rep(phase_history[0].orders, out=out)
     else:
-        return phase_orders_to_rep([])
+        return phase_orders_to_rep([], out=out)
+
+
+def get_board_plus_phase_orders(state, phase_orders, out=None):
+    """
+    Given the state of a game and the orders of a phase, returns the board state and the orders in a single array,
+    same as concatenating get_board_state and phase_orders_to_rep
 
+    :param state: state of the game
+    :param phase_orders: the orders of a phase
+    :param out: optional array of shape (num_locs, loc_vector_length + order_size) to write into
+    :return: an array of shape (num_locs, loc_vector_length + order_size)
+    """
+    if out is None:
+        out = np.zeros((len(LOCATIONS), LOC_VECTOR_LENGTH + order_utils.ORDER_SIZE))
+
+    get_board_state(state, out=out[:, :LOC_VECTOR_LENGTH])
+    phase_orders_to_rep(phase_orders, out=out[:, LOC_VECTOR_LENGTH:])
+
+    return out
 
-def phase_orders_to_rep(phase_orders):
+
+def phase_orders_to_rep(phase_orders, out=None):
     """
     Given the list of orders of a phase, this function returns an array representing the orders.
     The array has dimensions (num_locs, order_size) and contains information
     about the order type, unit type, and target location for each location on the board.
 
     :param phase_orders: a list of strings representing the orders of a phase.
+    :param out: optional array of shape (num_locs, order_size) to write the orders into
     :return: an array of shape (num_locs, order_size) containing information about the orders of the phase.
     """
+    if out is None:
+        phase_orders_rep = np.zeros((len(LOCATIONS), order_utils.ORDER_SIZE))
+    else:
+        phase_orders_rep = out
+        phase_orders_rep.fill(0)
+
     if not phase_orders:
-        return np.zeros((len(LOCATIONS), order_utils.ORDER_SIZE))
+        return phase_orders_rep
 
     phase_orders = sum(phase_orders.values(), [])
     order_by_loc = {order.split()[1]: order_utils.order_to_rep(order) for order in phase_orders
-                    if order != 'WAIVE' and order in ACTION_LIST}
+                    if order != 'WAIVE' and order in order_utils.ORDER_TO_IX}
 
-    phase_orders_rep = [order_by_loc[loc] if loc in order_by_loc else np.zeros(order_utils.ORDER_SIZE) for i, loc in enumerate(LOCATIONS)]
+    for loc_ix, loc in enumerate(LOCATIONS):
+        if loc in order_by_loc:
+            phase_orders_rep[loc_ix] = order_by_loc[loc]
 
-    return np.array(phase_orders_rep)
+    return phase_orders_rep
@@ -16,6 +16,37 @@ TARGET_LOC_INDEX = 3
 EXTRA_LOC_1_INDEX = 4
 EXTRA_LOC_INDEXES = [4, 5, 6, 7]
 
+ORDER_TO_IX = {order: ix for ix, order in enumerate(ACTION_LIST)}
+
+VALID_ORDERS_CACHE_SIZE = 64
+_valid_orders_cache = {}
+
+
+def get_valid_orders(game):
+    """
+    Given a game object, returns the valid orders for the unit located at each location.
+    The orders are represented by the index of the order in the ACTION_LIST, and the orders of all locations are
+    concatenated, ordered as LOCATIONS: the orders of LOCATIONS[i] are valid_orders[loc_offsets[i]:loc_offsets[i + 1]].
+    Possible orders only change when the game is processed, so the result is cached for each game phase.
+    :param game: game object
+    :return: a LongTensor with the valid orders and a LongTensor of size len(LOCATIONS) + 1 with the offsets
+    """
+    key = (game.game_id, game.get_current_phase())
+
+    if key not in _valid_orders_cache:
+        if len(_valid_orders_cache) >= VALID_ORDERS_CACHE_SIZE:
+            del _valid_orders_cache[next(iter(_valid_orders_cache))]
+
+        possible_orders = game.get_all_possible_orders()
+        orders_by_loc = [[ORDER_TO_IX[order] for order in possible_orders.get(loc, []) if order in ORDER_TO_IX]
+                         for loc in LOCATIONS]
+
+        valid_orders = torch.LongTensor([order for orders in orders_by_loc for order in orders])
+        loc_offsets = torch.LongTensor([0] + [len(orders) for orders in orders_by_loc]).cumsum(0)
+        _valid_orders_cache[key] = (valid_orders, loc_offsets)
+
+    return _valid_orders_cache[key]
+
 
 def get_loc_valid_orders(game, loc):
     """
@@ -25,9 +56,9 @@ def get_loc_valid_orders(game, loc):
     :param loc: a string representing the location
     :return: a list of integers representing valid orders for the unit at the location
     """
-    possible_orders = game.get_all_possible_orders()
-    orders = [ACTION_LIST.index(order) for order in possible_orders[loc] if order in ACTION_LIST]
-    return orders
+    valid_orders, loc_offsets = get_valid_orders(game)
+    loc_ix = LOC_TO_IX[loc]
+    return valid_orders[loc_offsets[loc_ix]:loc_offsets[loc_ix + 1]].tolist()
 
 
 def loc_to_ix(loc: str) -> int:
@@ -36,7 +67,7 @@ def loc_to_ix(loc: str) -> int:
     :param loc: a string representing the location
     :return: an integer representing the index of the location in the LOCATIONS list
     """
-    return LOCATIONS.index(loc.upper())
+    return LOC_TO_IX[loc.upper()]
 
 
 def ix_to_loc(ix: int) -> str:
@@ -54,7 +85,7 @@ def loc_to_rep(loc: str) -> int:
     :param loc: a string representing the location
     :return: an integer representing the location
     """
-    return LOCATIONS.index(loc.upper()) + 1
+    return LOC_TO_IX[loc.upper()] + 1
 
 
 def rep_to_loc(ix: int) -> str:
@@ -164,8 +195,8 @@ def order_to_ix(order: str):
     if 'VIA' in order:
         order = order.split('VIA')[0]
         order += 'VIA'
-    if order in ACTION_LIST:
-        return ACTION_LIST.index(order)
+    if order in ORDER_TO_IX:
+        return ORDER_TO_IX[order]
     else:
         return None
 
@@ -313,14 +344,21 @@ def filter_orders(dist, game, power_name, orderable_locs):
    :param orderable_locs: a dictionary of orderable locations for each power
    :return: a torch tensor representing the filtered distribution of probabilities for all orders
    """
-    dist_clone = dist.clone().detach()
-    order_mask = torch.ones_like(dist_clone, dtype=torch.bool)
-    for i, loc in enumerate(orderable_locs[power_name]):
-        order_mask[i, get_loc_valid_orders(game, loc)] = False
+    valid_orders, loc_offsets = get_valid_orders(game)
+    locs_ix = torch.LongTensor([LOC_TO_IX[loc] for loc in orderable_locs[power_name]])
+
+    # row and column of every valid order, so the mask is built with a single indexed assignment
+    starts = loc_offsets[locs_ix]
+    counts = loc_offsets[locs_ix + 1] - starts
+    rows = torch.arange(len(locs_ix)).repeat_interleave(counts)
+    # each order's position in valid_orders is the start of its location plus its index among the location's orders
+    positions = torch.arange(len(rows)) + (starts - (counts.cumsum(0) - counts)).repeat_interleave(counts)
+    cols = valid_orders[positions]
 
-    dist_clone = dist_clone.masked_fill(order_mask, value=-float("inf"))
+    valid_mask = torch.zeros_like(dist, dtype=torch.bool)
+    valid_mask[rows.to(dist.device), cols.to(dist.device)] = True
 
-    return dist_clone
+    return dist.detach().masked_fill(~valid_mask, value=-float("inf"))
 
 
 def select_orders(dist, game, power_name, orderable_locs):
@@ -333,24 +371,43 @@ def select_orders(dist, game, power_name, orderable_locs):
     :param orderable_locs: a dictionary of orderable locations for each power
     :return: a list of indices of the sampled orders
     """
+    actions, _ = sample_orders(dist, game, power_name, orderable_locs)
+
+    return actions
+
+
+def sample_orders(dist, game, power_name, orderable_locs):
+    """
+    Given the order logits of a power, a game object, the name of the power, and a dictionary of orderable locations,
+    samples valid orders with the Gumbel-max trick and returns them with their log probabilities under dist.
+    On adjustment phases, n_builds orders are sampled without replacement from all locations at once.
+    :param dist: a torch tensor with the logits of every order for each orderable location of the power
+    :param game: a game object
+    :param power_name: name of a power
+    :param orderable_locs: a dictionary of orderable locations for each power
+    :return: a LongTensor with the indices of the sampled orders and a tensor with their log probabilities
+    """
     dist_clone = filter_orders(dist, game, power_name, orderable_locs)
 
     state = game.get_state()
 
     n_builds = abs(state['builds'][power_name]['count'])
 
+    # the argmax of logits perturbed with Gumbel noise is a sample from their softmax
+    gumbel_noise = -torch.empty_like(dist_clone).exponential_().log()
+
     if n_builds > 0:
         dist_clone[:, 0] = - float("inf")
 
-        dist_clone = F.softmax(dist_clone.reshape(-1), dim=0)
+        flat_actions = torch.topk((dist_clone + gumbel_noise).reshape(-1), n_builds).indices
 
-        actions = [ix % len(dist[0]) for ix in torch.multinomial(dist_clone, n_builds)]
+        actions = flat_actions % dist.shape[1]
+        log_probs = F.log_softmax(dist.reshape(-1), dim=0)[flat_actions]
     else:
-        dist_clone = F.softmax(dist_clone, dim=1)
-
-        actions = torch.multinomial(dist_clone, 1)
+        actions = torch.argmax(dist_clone + gumbel_noise, dim=1)
+        log_probs = F.log_softmax(dist, dim=1).gather(1, actions.unsqueeze(1)).squeeze(1)
 
-    return actions
+    return actions, log_probs
 
 
 def get_max_orders(dist, game, power_name, orderable_locs):
@@ -1,10 +1,11 @@
 import asyncio
-
+import os
 import time
 
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from environment.action_list import ACTION_LIST
 from environment.constants import LOCATIONS, ALL_POWERS
@@ -13,12 +14,15 @@ from environment.message_utils import filter_messages, get_daide_msg_ix, get_msg
     is_daide_msg_reply, \
     send_message, split_DMZ
 from environment.observation_utils import LOC_VECTOR_LENGTH, get_board_state, get_last_phase_orders
-from environment.order_utils import ORDER_SIZE, loc_to_ix, ix_to_order, select_orders
+from environment.order_utils import ORDER_SIZE, ix_to_order, select_orders
+from players.Player import EncoderLayer, get_padded_locs_ix
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # device = torch.device("cpu")
 
-torch.autograd.set_detect_anomaly(True)
+# anomaly detection slows down every backward pass, so it is only enabled for debugging
+if os.environ.get("DEBUG_AUTOGRAD"):
+    torch.autograd.set_detect_anomaly(True)
 
 
 class MessagePlayer:
@@ -140,7 +144,6 @@ class Brain(nn.Module):
 
         # Policy Network
         # LSTM Decoder: encoded state (embed_size) > action probabilities (len(ACTION_LIST))
-        self.hidden = self.init_hidden()
         self.lstm = nn.LSTM(embed_size * 2, lstm_size, num_layers=lstm_layers)
         self.linearPolicy = nn.Linear(lstm_size, len(ACTION_LIST))
 
@@ -153,27 +156,33 @@ class Brain(nn.Module):
         self.msgOutputLinear = nn.Linear(len(LOCATIONS) * embed_size + embed_size, len(MESSAGE_LIST))
         self.msgReplyLinear = nn.Linear(len(LOCATIONS) * embed_size + embed_size, len(ANSWER_LIST))
 
-    def init_hidden(self):
-        return (torch.zeros(self.lstm_layers, 1, self.lstm_size).to(device),
-                torch.zeros(self.lstm_layers, 1, self.lstm_size).to(device))
+    def init_hidden(self, batch_size=1):
+        return (torch.zeros(self.lstm_layers, batch_size, self.lstm_size).to(device),
+                torch.zeros(self.lstm_layers, batch_size, self.lstm_size).to(device))
 
     def forward(self, x_bo, x_po, msg_logs, powers, locs_by_power):
         x = self.encoder(x_bo, x_po)
 
         # policy
-        dist = {}
-        for power in powers:
-            if not locs_by_power[power]:
-                dist[power] = torch.Tensor([]).to(device)
-            else:
-                msg_state_embed = F.relu(self.msgEmbedLinear(torch.flatten(msg_logs[power])))
-                self.hidden = self.init_hidden()
-                locs_ix = [loc_to_ix(loc) for loc in locs_by_power[power]]
-                locs_emb = x[locs_ix]
-                x_pol, self.hidden = self.lstm(torch.cat([locs_emb, msg_state_embed.repeat(len(locs_ix), 1, 1)], dim=2),
-                                               self.hidden)
-                x_pol = self.linearPolicy(x_pol)
-                dist[power] = torch.reshape(x_pol, (len(locs_ix), -1))
+        dist = {power: torch.Tensor([]).to(device) for power in powers}
+
+        # the locations of each power are one sequence, all powers are decoded in a single LSTM batch
+        ordering_powers = [power for power in powers if locs_by_power[power]]
+        if ordering_powers:
+            locs_ix, lengths = get_padded_locs_ix([locs_by_power[power] for power in ordering_powers])
+            locs_emb = x[locs_ix.to(device, non_blocking=True), 0]
+
+            msg_logs = torch.stack([torch.flatten(msg_logs[power]) for power in ordering_powers])
+            msg_state_embed = F.relu(self.msgEmbedLinear(msg_logs))
+            x_pol = torch.cat([locs_emb, msg_state_embed.expand(len(locs_emb), -1, -1)], dim=2)
+
+            x_pol, _ = self.lstm(pack_padded_sequence(x_pol, lengths, enforce_sorted=False),
+                                 self.init_hidden(len(ordering_powers)))
+            x_pol = x_pol._replace(data=self.linearPolicy(x_pol.data))
+            x_pol, _ = pad_packed_sequence(x_pol)
+
+            for i, power in enumerate(ordering_powers):
+                dist[power] = x_pol[:lengths[i], i]
 
         # value
         x_value = torch.flatten(x)
@@ -210,14 +219,16 @@ class Encoder(nn.Module):
         self.linear = nn.Linear(self.state_size, embed_size)
 
         self.positional_bias = nn.Parameter(torch.nn.init.kaiming_uniform_(torch.empty(len(LOCATIONS), 1, embed_size)))
-        encoder_layer = nn.TransformerEncoderLayer(d_model=embed_size, nhead=transformer_heads,
-                                                   dim_feedforward=embed_size)
-        self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=transformer_layers)
+        encoder_layer = EncoderLayer(embed_size, transformer_heads, dim_feedforward=embed_size)
+        self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=transformer_layers,
+                                                         enable_nested_tensor=False)
 
     def forward(self, x_bo, x_po):
-        x = torch.cat([x_bo, x_po], -1)
-        x = self.linear(x)
-        x = torch.reshape(x, (-1, 1, self.embed_size))
-        x = x + self.positional_bias
-        x = self.transformer_encoder(x)
-        return x
+        # the transformer runs in bfloat16 on gpu, the output is cast back to float32 for the policy and value heads
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+            x = torch.cat([x_bo, x_po], -1)
+            x = self.linear(x)
+            x = torch.reshape(x, (-1, 1, self.embed_size))
+            x = x + self.positional_bias
+            x = self.transformer_encoder(x)
+        return x.float()
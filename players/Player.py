@@ -1,22 +1,31 @@
+import os
+
+import numpy as np
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from tornado import gen
 
 from environment.action_list import ACTION_LIST
-from environment.constants import LOCATIONS, ALL_POWERS
+from environment.constants import LOCATIONS, ALL_POWERS, LOC_TO_IX
 from environment.observation_utils import LOC_VECTOR_LENGTH, get_board_state, get_last_phase_orders
-from environment.order_utils import ORDER_SIZE, loc_to_ix, ix_to_order, select_orders
+from environment.order_utils import ORDER_SIZE, ix_to_order, select_orders
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # device = torch.device("cpu")
 
-torch.autograd.set_detect_anomaly(True)
+# allow TF32 tensor cores for the float32 matmuls that run outside autocast
+torch.set_float32_matmul_precision('high')
+
+# anomaly detection slows down every backward pass, so it is only enabled for debugging
+if os.environ.get("DEBUG_AUTOGRAD"):
+    torch.autograd.set_detect_anomaly(True)
 
 
 class Player:
     def __init__(self, model_path=None, embed_size=224, transformer_layers=5, transformer_heads=8, lstm_size=200,
-                 lstm_layers=2):
+                 lstm_layers=2, compile_model=False, num_games=1, quantize=False):
         self.brain = Brain(embed_size=embed_size, transformer_layers=transformer_layers,
                            transformer_heads=transformer_heads, lstm_size=lstm_size, lstm_layers=lstm_layers)
 
@@ -26,18 +35,93 @@ class Player:
 
         self.brain.to(device)
 
+        if quantize:
+            if device.type != 'cpu':
+                raise ValueError(f"Dynamic int8 quantization is only supported on cpu, not {device.type}")
+
+            # int8 weights for the linear layers of the encoder, only meant for playing, not for training
+            self.brain.eval()
+            self.brain.encoder = torch.ao.quantization.quantize_dynamic(self.brain.encoder, {nn.Linear},
+                                                                        dtype=torch.qint8)
+
+        # a compiled model always gets a batch of num_games states from get_state_tensors, so the encoder and the value
+        # network see a single input shape and are only compiled once
+        self.pad_batch = compile_model
+        if compile_model:
+            self.brain.encoder.forward = compile_for_training_and_inference(self.brain.encoder.forward)
+            # so the value network's linear layers and relu are fused instead of launched one by one
+            self.brain.value_head = compile_for_training_and_inference(self.brain.value_head)
+
+        # staging buffer for the observations of up to num_games games, the board state followed by the previous
+        # orders of each location, pinned so it is copied to the gpu asynchronously
+        pin_memory = device.type == 'cuda'
+        self.state_buffer = torch.zeros((num_games, len(LOCATIONS), LOC_VECTOR_LENGTH + ORDER_SIZE),
+                                        pin_memory=pin_memory)
+        self.copy_done = torch.cuda.Event() if pin_memory else None
+
+    def get_state_tensors(self, games):
+        """
+        Given up to num_games games, returns their board states followed by the previous orders in a single tensor.
+        If the model is compiled, the batch is padded to num_games states, so it always sees the same input shape
+        :param games: list of game objects
+        :return: tensor of shape (batch_size, num_locs, loc_vector_length + order_size), where the first len(games)
+        states are the states of the given games and batch_size is num_games if the model is compiled, else len(games)
+        :raises: ValueError if more than num_games games are given
+        """
+        if len(games) > len(self.state_buffer):
+            raise ValueError(f"Got {len(games)} games, but the player was created for {len(self.state_buffer)}")
+
+        # the buffer can only be overwritten once the previous copy has finished
+        if self.copy_done:
+            self.copy_done.synchronize()
+
+        for game, state in zip(games, self.state_buffer.numpy()):
+            get_board_state(game.get_state(), out=state[:, :LOC_VECTOR_LENGTH])
+            get_last_phase_orders(game, out=state[:, LOC_VECTOR_LENGTH:])
+
+        # always a copy, on cpu .to would return a view of the buffer, which is overwritten in the next step while the
+        # autograd graph still refers to it
+        states = self.state_buffer if self.pad_batch else self.state_buffer[:len(games)]
+        states = states.to(device, non_blocking=True, copy=True)
+
+        if self.copy_done:
+            self.copy_done.record()
+
+        return states
+
     @gen.coroutine
     def get_orders(self, game, power_name):
-        board_state = torch.Tensor(get_board_state(game.get_state())).to(device)
-        prev_orders = torch.Tensor(get_last_phase_orders(game)).to(device)
+        if not game.get_orderable_locations(power_name):
+            return []
+
         orderable_locs = game.get_orderable_locations()
-        dist, _ = self.brain(board_state, prev_orders, [power_name], orderable_locs)
+        with torch.no_grad():
+            dists, _ = self.brain.forward_batch(self.get_state_tensors([game]), [[power_name]], [orderable_locs])
 
-        actions = select_orders(dist[power_name], game, power_name, orderable_locs)
+        actions = select_orders(dists[0][power_name], game, power_name, orderable_locs)
 
         return [ix_to_order(ix) for ix in actions]
 
 
+def compile_for_training_and_inference(fn):
+    """
+    Compiles a function twice, with CUDA graphs (reduce-overhead mode) for inference and with the default mode for
+    training. In training, the forwards of a whole episode run before its backward, and CUDA graph trees record every
+    forward with a pending backward as a new graph instead of replaying the same one
+    :param fn: function to compile
+    :return: a function that calls the compiled version for the current grad mode
+    """
+    training_fn = torch.compile(fn)
+    inference_fn = torch.compile(fn, mode="reduce-overhead")
+
+    def compiled_fn(*args, **kwargs):
+        if torch.is_grad_enabled():
+            return training_fn(*args, **kwargs)
+        return inference_fn(*args, **kwargs)
+
+    return compiled_fn
+
+
 class Brain(nn.Module):
     def __init__(self, state_size=LOC_VECTOR_LENGTH + ORDER_SIZE, embed_size=224, transformer_layers=10,
                  transformer_heads=8, lstm_size=200, lstm_layers=2):
@@ -52,7 +136,6 @@ class Brain(nn.Module):
 
         # Policy Network
         # LSTM Decoder: encoded state (embed_size) > action probabilities (len(ACTION_LIST))
-        self.hidden = self.init_hidden()
         self.lstm = nn.LSTM(embed_size, lstm_size, num_layers=lstm_layers)
         self.linearPolicy = nn.Linear(lstm_size, len(ACTION_LIST))
 
@@ -60,32 +143,74 @@ class Brain(nn.Module):
         self.linear1 = nn.Linear(len(LOCATIONS) * embed_size, embed_size)
         self.linear2 = nn.Linear(embed_size, len(ALL_POWERS))
 
-    def init_hidden(self):
-        return (torch.zeros(self.lstm_layers, 1, self.lstm_size).to(device),
-                torch.zeros(self.lstm_layers, 1, self.lstm_size).to(device))
+    def init_hidden(self, batch_size=1):
+        return (torch.zeros(self.lstm_layers, batch_size, self.lstm_size).to(device),
+                torch.zeros(self.lstm_layers, batch_size, self.lstm_size).to(device))
 
-    def forward(self, x_bo, x_po, powers, locs_by_power):
-        x = self.encoder(x_bo, x_po)
+    def forward(self, x, powers, locs_by_power):
+        dists, values = self.forward_batch(x.unsqueeze(0), [powers], [locs_by_power])
+        return dists[0], values[0]
+
+    def forward_batch(self, x, powers_by_game, locs_by_game):
+        """
+        Same as forward, but for a batch of games. The encoder and the value network run once for the whole batch,
+        and the orderable locations of every power of every game are decoded in a single LSTM batch.
+        :param x: board states followed by the previous orders, tensor of shape
+        (num_games, num_locs, loc_vector_length + order_size)
+        :param powers_by_game: list with the powers to get orders for in each game
+        :param locs_by_game: list with the orderable locations of each power in each game
+        :return: a list with a dictionary of order logits for each game and a tensor of shape (num_games, num_powers)
+        with the values
+        """
+        x = self.encoder(x)
 
         # policy
-        dist = {}
-        for power in powers:
-            if not locs_by_power[power]:
-                dist[power] = torch.Tensor([]).to(device)
-            else:
-                self.hidden = self.init_hidden()
-                locs_ix = [loc_to_ix(loc) for loc in locs_by_power[power]]
-                locs_emb = x[locs_ix]
-                x_pol, self.hidden = self.lstm(locs_emb, self.hidden)
-                x_pol = self.linearPolicy(x_pol)
-                dist[power] = torch.reshape(x_pol, (len(locs_ix), -1))
-
-        # value
-        x_value = torch.flatten(x)
+        dists = [{power: torch.Tensor([]).to(device) for power in powers} for powers in powers_by_game]
+
+        # the locations of each power are one sequence
+        sequences = [(game_ix, power) for game_ix, powers in enumerate(powers_by_game) for power in powers
+                     if locs_by_game[game_ix][power]]
+        if sequences:
+            locs_ix, lengths = get_padded_locs_ix([locs_by_game[game_ix][power] for game_ix, power in sequences])
+            games_ix = torch.LongTensor([game_ix for game_ix, _ in sequences])
+            locs_emb = x[locs_ix.to(device, non_blocking=True), games_ix.to(device, non_blocking=True)]
+
+            x_pol, _ = self.lstm(pack_padded_sequence(locs_emb, lengths, enforce_sorted=False),
+                                 self.init_hidden(len(sequences)))
+            x_pol = x_pol._replace(data=self.linearPolicy(x_pol.data))
+            x_pol, _ = pad_packed_sequence(x_pol)
+
+            for i, (game_ix, power) in enumerate(sequences):
+                dists[game_ix][power] = x_pol[:lengths[i], i]
+
+        values = self.value_head(x)
+
+        return dists, values
+
+    def value_head(self, x):
+        """
+        Value network, estimates the value of the board for each power
+        :param x: encoded board states, tensor of shape (num_locs, num_games, embed_size)
+        :return: a tensor of shape (num_games, num_powers) with the values
+        """
+        x_value = torch.flatten(torch.transpose(x, 0, 1), start_dim=1)
         x_value = F.relu(self.linear1(x_value))
-        value = self.linear2(x_value)
+        return self.linear2(x_value)
+
 
-        return dist, value
+def get_padded_locs_ix(locs_list):
+    """
+    Given lists of orderable locations, returns a tensor with the location indexes of each list in a column,
+    padded with zeros to the length of the longest one
+    :param locs_list: list of non-empty lists of orderable locations
+    :return: a LongTensor of shape (max_locs, len(locs_list)) and the number of locations in each list
+    """
+    lengths = [len(locs) for locs in locs_list]
+    locs_ix = np.zeros((max(lengths), len(locs_list)), dtype=np.int64)
+    for i, locs in enumerate(locs_list):
+        locs_ix[:lengths[i], i] = np.fromiter((LOC_TO_IX[loc] for loc in locs), dtype=np.int64, count=lengths[i])
+
+    return torch.from_numpy(locs_ix), lengths
 
 
 class Encoder(nn.Module):
@@ -97,13 +222,105 @@ class Encoder(nn.Module):
         self.linear = nn.Linear(self.state_size, embed_size)
 
         self.positional_bias = nn.Parameter(torch.nn.init.kaiming_uniform_(torch.empty(len(LOCATIONS), 1, embed_size)))
-        encoder_layer = nn.TransformerEncoderLayer(d_model=embed_size, nhead=transformer_heads, dim_feedforward=embed_size)
-        self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=transformer_layers)
-
-    def forward(self, x_bo, x_po):
-        x = torch.cat([x_bo, x_po], -1)
-        x = self.linear(x)
-        x = torch.reshape(x, (-1, 1, self.embed_size))
-        x = x + self.positional_bias
-        x = self.transformer_encoder(x)
-        return x
\ No newline at end of file
+        encoder_layer = EncoderLayer(embed_size, transformer_heads, dim_feedforward=embed_size)
+        self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=transformer_layers,
+                                                         enable_nested_tensor=False)
+
+    def forward(self, x):
+        # the transformer runs in bfloat16 on gpu, the output is cast back to float32 for the policy and value heads
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+            x = self.linear(x)
+            # (num_games, num_locs, embed_size) > (num_locs, num_games, embed_size)
+            x = torch.transpose(x, 0, 1)
+            x = x + self.positional_bias
+            x = self.transformer_encoder(x)
+        return x.float()
+
+
+class EncoderLayer(nn.Module):
+    """
+    Drop-in replacement for nn.TransformerEncoderLayer (post-norm, relu, sequence first) that computes attention
+    with a single packed QKV projection and F.scaled_dot_product_attention.
+    Parameter names match nn.TransformerEncoderLayer, so models saved with it can still be loaded.
+    """
+    def __init__(self, embed_size, heads, dim_feedforward, dropout=0.1):
+        super(EncoderLayer, self).__init__()
+        self.dropout = dropout
+
+        self.self_attn = SelfAttention(embed_size, heads, dropout)
+
+        self.linear1 = nn.Linear(embed_size, dim_feedforward)
+        self.linear2 = nn.Linear(dim_feedforward, embed_size)
+
+        self.norm1 = nn.LayerNorm(embed_size)
+        self.norm2 = nn.LayerNorm(embed_size)
+
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, is_causal=False):
+        x = self.norm1(src + F.dropout(self.self_attn(src, src_mask, src_key_padding_mask, is_causal),
+                                       self.dropout, self.training))
+
+        x_ff = F.dropout(F.relu(self.linear1(x)), self.dropout, self.training)
+        x = self.norm2(x + F.dropout(self.linear2(x_ff), self.dropout, self.training))
+        return x
+
+
+class SelfAttention(nn.Module):
+    def __init__(self, embed_size, heads, dropout=0.1):
+        super(SelfAttention, self).__init__()
+        self.heads = heads
+        self.dropout = dropout
+        # read by nn.TransformerEncoder
+        self.batch_first = False
+
+        # Q, K and V projections packed in one matrix, computed with a single GEMM
+        self.in_proj_weight = nn.Parameter(nn.init.xavier_uniform_(torch.empty(3 * embed_size, embed_size)))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * embed_size))
+        self.out_proj = nn.Linear(embed_size, embed_size)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, x, attn_mask=None, key_padding_mask=None, is_causal=False):
+        """
+        :param x: tensor of shape (seq_len, batch_size, embed_size)
+        :param attn_mask: optional mask of shape (seq_len, seq_len) or (batch_size * heads, seq_len, seq_len)
+        :param key_padding_mask: optional mask of shape (batch_size, seq_len) of the positions to ignore
+        :param is_causal: if True and attn_mask is not given, each position only attends to the previous ones
+        :return: tensor of shape (seq_len, batch_size, embed_size)
+        """
+        seq_len, batch_size, embed_size = x.shape
+
+        # (seq, batch, 3 * embed) > 3 x (batch, heads, seq, head_dim)
+        qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias)
+        qkv = qkv.reshape(seq_len, batch_size, 3, self.heads, -1).permute(2, 1, 3, 0, 4)
+
+        if attn_mask is None and is_causal and key_padding_mask is not None:
+            attn_mask = nn.Transformer.generate_square_subsequent_mask(seq_len, device=x.device)
+        if attn_mask is not None:
+            attn_mask = to_additive_mask(attn_mask, qkv.dtype)
+            if attn_mask.dim() == 3:
+                # (batch * heads, seq, seq) > (batch, heads, seq, seq)
+                attn_mask = attn_mask.view(batch_size, self.heads, seq_len, seq_len)
+        if key_padding_mask is not None:
+            # (batch, seq) > (batch, 1, 1, seq), merged with attn_mask into a single mask added to the scores
+            key_padding_mask = to_additive_mask(key_padding_mask, qkv.dtype).view(batch_size, 1, 1, seq_len)
+            attn_mask = key_padding_mask if attn_mask is None else attn_mask + key_padding_mask
+
+        x = F.scaled_dot_product_attention(qkv[0], qkv[1], qkv[2], attn_mask=attn_mask,
+                                           dropout_p=self.dropout if self.training else 0.0,
+                                           is_causal=is_causal and attn_mask is None)
+
+        # (batch, heads, seq, head_dim) > (seq, batch, embed)
+        x = x.permute(2, 0, 1, 3).reshape(seq_len, batch_size, embed_size)
+        return self.out_proj(x)
+
+
+def to_additive_mask(mask, dtype):
+    """
+    Converts an attention mask in the nn.TransformerEncoderLayer format, where True means the position is ignored,
+    to the values that are added to the attention scores
+    :param mask: bool or float mask
+    :param dtype: dtype of the attention scores
+    :return: float mask of the given dtype
+    """
+    if mask.dtype == torch.bool:
+        return torch.zeros_like(mask, dtype=dtype).masked_fill(mask, -float("inf"))
+    return mask.to(dtype)
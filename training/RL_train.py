@@ -5,53 +5,48 @@ import torch
 from diplomacy import Game
 from diplomacy.utils.export import to_saved_game_format
 from torch import optim as optim
-from torch.distributions import Categorical
-from torch.nn import functional as F
 
 from players.Player import Player, device
 from StatTracker import StatTracker
 from environment.constants import ALL_POWERS
-from environment.observation_utils import get_board_state, get_last_phase_orders
-from environment.order_utils import ix_to_order, select_orders
+from environment.order_utils import ix_to_order, sample_orders
 
 
-def train_rl(num_episodes, learning_rate=0.001, model_path=None, gamma=0.99):
-    def calculate_backdrop(player, game, episode_values, episode_log_probs, episode_rewards, optimizer):
-        board_state = torch.Tensor(get_board_state(game.get_state())).to(device)
-        prev_orders = torch.Tensor(get_last_phase_orders(game)).to(device)
+def train_rl(num_episodes, learning_rate=0.001, model_path=None, gamma=0.99, compile_model=False, max_steps=1000,
+             num_games=1):
+    def calculate_backdrop(player, games, episode_values, episode_log_probs, episode_rewards, optimizer):
+        states = player.get_state_tensors(games)
 
-        orderable_locs = game.get_orderable_locations()
-        _, new_values = player(board_state, prev_orders, ALL_POWERS, orderable_locs)
+        orderable_locs = [game.get_orderable_locations() for game in games]
+        _, new_values = player.brain.forward_batch(states, [ALL_POWERS] * len(games), orderable_locs)
 
-        for power_idx, power in enumerate(ALL_POWERS):
-            log_probs = episode_log_probs[power]
-            values = episode_values[power]
-            rewards = episode_rewards[power]
-            qval = new_values[power_idx]
+        total_loss = 0
+        for game_ix in range(len(games)):
+            episode_qvals = get_discounted_returns(episode_rewards[game_ix], new_values[game_ix].detach(), gamma)
 
-            qvals = np.zeros(len(values))
-            for t in reversed(range(len(rewards))):
-                qval = rewards[t] + gamma * qval
-                qvals[t] = qval
+            for power_idx, power in enumerate(ALL_POWERS):
+                log_probs = episode_log_probs[game_ix][power]
+                values = episode_values[game_ix][:, power_idx]
+                qvals = episode_qvals[:, power_idx]
 
-            # update actor critic
-            values = torch.stack(values)
-            qvals = torch.FloatTensor(qvals).to(device)
+                # update actor critic
+                advantage = qvals - values
 
-            advantage = qvals - values
+                step_actor_loss = []
+                for step, step_log_probs in enumerate(log_probs):
+                    step_actor_loss.append((-step_log_probs * advantage[step].detach()).mean())
+                actor_loss = torch.stack(step_actor_loss).mean()
 
-            step_actor_loss = []
-            for step, step_log_probs in enumerate(log_probs):
-                step_actor_loss.append((-step_log_probs * advantage[step].detach()).mean())
-            actor_loss = torch.stack(step_actor_loss).mean()
+                critic_loss = 0.5 * advantage.pow(2).mean()
 
-            critic_loss = 0.5 * advantage.pow(2).mean()
+                total_loss = total_loss + actor_loss + critic_loss
 
-            optimizer.zero_grad()
-            actor_loss.backward(retain_graph=True)
-            critic_loss.backward(retain_graph=True)
+        # a single backward pass through the shared encoder for all powers, and one update per episode
+        optimizer.zero_grad(set_to_none=True)
+        total_loss.backward()
+        optimizer.step()
 
-    player = Player(model_path)
+    player = Player(model_path, compile_model=compile_model, num_games=num_games)
 
     player.brain.train()
 
@@ -60,73 +55,125 @@ def train_rl(num_episodes, learning_rate=0.001, model_path=None, gamma=0.99):
     stat_tracker = StatTracker()
 
     for episode in range(num_episodes):
-        game = Game()
-        stat_tracker.new_game(game)
+        # num_games games are played at the same time, so the model runs on a batch of states at each step
+        games = [Game() for _ in range(num_games)]
+        stat_tracker.new_game(games[0])
 
-        prev_score = {power_name: len(game.get_state()["centers"][power_name]) for power_name in ALL_POWERS}
-        episode_values = {power_name: [] for power_name in ALL_POWERS}
-        episode_log_probs = {power_name: [] for power_name in ALL_POWERS}
-        episode_rewards = {power_name: [] for power_name in ALL_POWERS}
+        scores = np.empty((num_games, len(ALL_POWERS)), dtype=np.int32)
+        prev_scores = np.empty((num_games, len(ALL_POWERS)), dtype=np.int32)
+        for game, prev_score in zip(games, prev_scores):
+            get_scores(game, prev_score)
+        episode_values = [torch.empty(max_steps, len(ALL_POWERS), device=device) for _ in games]
+        episode_log_probs = [{power_name: [] for power_name in ALL_POWERS} for _ in games]
+        episode_rewards = torch.zeros(num_games, max_steps, len(ALL_POWERS))
 
-        step = 0
-        while not game.is_game_done:
-            step += 1
+        steps = [0] * num_games
+        active_games_ix = list(range(num_games))
+        while active_games_ix:
+            active_games = [games[game_ix] for game_ix in active_games_ix]
 
-            board_state = torch.Tensor(get_board_state(game.get_state())).to(device)
-            prev_orders = torch.Tensor(get_last_phase_orders(game)).to(device)
+            states = player.get_state_tensors(active_games)
 
-            orderable_locs = game.get_orderable_locations()
-            dist, values = player.brain(board_state, prev_orders, ALL_POWERS, orderable_locs)
+            orderable_locs = [game.get_orderable_locations() for game in active_games]
+            dists, values = player.brain.forward_batch(states, [ALL_POWERS] * len(active_games), orderable_locs)
 
-            for power, value in zip(ALL_POWERS, values):
-                episode_values[power].append(value)
+            for game_ix, game, dist, game_values, game_orderable_locs in zip(active_games_ix, active_games, dists,
+                                                                             values, orderable_locs):
+                steps[game_ix] += 1
 
-            for power in ALL_POWERS:
-                power_orders = []
+                episode_values[game_ix][steps[game_ix] - 1] = game_values
 
-                power_dist = F.softmax(dist[power], dim=1)
+                for power in ALL_POWERS:
+                    power_orders = []
 
-                if len(power_dist) > 0:
-                    actions = select_orders(dist[power], game, power, orderable_locs)
+                    if len(dist[power]) > 0:
+                        actions, log_probs = sample_orders(dist[power], game, power, game_orderable_locs)
+                        episode_log_probs[game_ix][power].append(log_probs)
 
-                    power_dist = Categorical(power_dist)
-                    episode_log_probs[power].append(power_dist.log_prob(actions))
+                        power_orders = [ix_to_order(ix) for ix in actions.tolist()]
 
-                    power_orders = [ix_to_order(ix) for ix in actions]
+                    game.set_orders(power, power_orders)
 
-                game.set_orders(power, power_orders)
+                game.process()
 
-            game.process()
+                get_scores(game, scores[game_ix])
+                set_rewards(game, scores[game_ix], prev_scores[game_ix],
+                            episode_rewards[game_ix, steps[game_ix] - 1].numpy())
+                prev_scores[game_ix] = scores[game_ix]
 
-            score = {power_name: len(game.get_state()["centers"][power_name]) for power_name in ALL_POWERS}
+                if game_ix == 0:
+                    stat_tracker.update(game)
 
-            for power_name in ALL_POWERS:
-                power_reward = np.subtract(score[power_name], prev_score[power_name])
-                if game.is_game_done and power_name in game.outcome:
-                    if score[power_name] >= 18:
-                        power_reward = 34
-                    else:
-                        power_reward = score[power_name] * 34 / sum(score.values())
+            active_games_ix = [game_ix for game_ix in active_games_ix
+                               if not games[game_ix].is_game_done and steps[game_ix] < max_steps]
 
-                episode_rewards[power_name].append(
-                    torch.tensor(
-                        power_reward,
-                        dtype=torch.float,
-                        device=device))
-            prev_score = score
+        episode_values = [game_values[:step] for game_values, step in zip(episode_values, steps)]
+        episode_rewards = [game_rewards[:step].to(device, non_blocking=True)
+                           for game_rewards, step in zip(episode_rewards, steps)]
+        calculate_backdrop(player, games, episode_values, episode_log_probs, episode_rewards, optimizer)
 
-            stat_tracker.update(game)
-
-        calculate_backdrop(player.brain, game, episode_values, episode_log_probs, episode_rewards, optimizer)
-
-        print(f'Game Done\nEpisode {episode}, Step {step}\nScore: {score}\nWinners:{game.outcome[1:]}')
-        stat_tracker.end_game()
+        for game_ix, game in enumerate(games):
+            print(f'Game Done\nEpisode {episode}, Game {game_ix}, Step {steps[game_ix]}\n'
+                  f'Score: {dict(zip(ALL_POWERS, scores[game_ix].tolist()))}\nWinners:{game.outcome[1:]}')
+            stat_tracker.end_game(game)
 
         if episode % 10 == 0:
             stat_tracker.plot_game()
             stat_tracker.plot_wins()
 
             with open(f'games/game_{episode}.json', 'w') as file:
-                file.write(json.dumps(to_saved_game_format(game)))
+                file.write(json.dumps(to_saved_game_format(games[0])))
 
             torch.save(player.brain.state_dict(), f'models/model_{episode}.pth')
+
+
+def get_discounted_returns(rewards, bootstrap_value, gamma):
+    """
+    Computes the discounted return of every step, q_t = r_t + gamma * q_t+1, without looping over the steps
+    :param rewards: tensor of shape (num_steps, num_powers) with the reward of each power at each step
+    :param bootstrap_value: tensor of shape (num_powers) with the estimated value of the state after the last step
+    :param gamma: discount factor
+    :return: tensor of shape (num_steps, num_powers) with the discounted returns
+    """
+    steps = torch.arange(len(rewards), device=rewards.device, dtype=rewards.dtype)
+
+    # discounts[t, k] = gamma^(k-t) for k >= t, so q_t = sum_k discounts[t, k] * r_k
+    # far away steps underflow to a discount of 0, nothing is divided by a power of gamma
+    discounts = torch.triu(gamma ** (steps.unsqueeze(0) - steps.unsqueeze(1)).clamp(min=0))
+
+    return discounts @ rewards + (gamma ** (len(rewards) - steps)).unsqueeze(1) * bootstrap_value
+
+
+def get_scores(game, out):
+    """
+    Writes the number of supply centers of each power, ordered as in ALL_POWERS, into out
+    :param game: game object
+    :param out: integer array of size len(ALL_POWERS)
+    :return: out
+    """
+    centers = game.get_state()["centers"]
+    for power_idx, power_name in enumerate(ALL_POWERS):
+        out[power_idx] = len(centers[power_name])
+    return out
+
+
+def set_rewards(game, score, prev_score, out):
+    """
+    Writes the reward of each power for the phase that was just processed into out.
+    The reward is the number of supply centers gained, except on the last phase, where the powers in the outcome of
+    the game get 34 for a solo victory, or a share of 34 proportional to their supply centers for a draw.
+    :param game: game object
+    :param score: number of supply centers of each power after the phase
+    :param prev_score: number of supply centers of each power before the phase
+    :param out: float array of size len(ALL_POWERS)
+    :return: out
+    """
+    out[:] = score - prev_score
+    if game.is_game_done:
+        for power_idx, power_name in enumerate(ALL_POWERS):
+            if power_name in game.outcome:
+                if score[power_idx] >= 18:
+                    out[power_idx] = 34
+                else:
+                    out[power_idx] = score[power_idx] * 34 / score.sum()
+    return out
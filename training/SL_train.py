@@ -5,7 +5,7 @@ from torch import optim as optim, nn as nn
 
 from players.Player import Player, device
 from environment.constants import POWER_ACRONYMS_LIST, ALL_POWERS
-from environment.observation_utils import get_board_state, phase_orders_to_rep
+from environment.observation_utils import get_board_plus_phase_orders
 from environment.order_utils import order_to_ix, get_max_orders
 from environment.action_list import ACTION_LIST
 import logging
@@ -96,8 +96,7 @@ def train_sl(dataset_path, model_path=None, print_ratio=0, save_ratio=1000, outp
 
                 last_phase_orders = []
                 for phase in obj['phases']:
-                    board_state = get_board_state(phase['state'])
-                    prev_orders = phase_orders_to_rep(last_phase_orders)
+                    state = get_board_plus_phase_orders(phase['state'], last_phase_orders)
                     powers = [power for power, orders in phase['orders'].items() if orders
                               and power in powers_to_learn]
                     orders = {power: [order for order in orders if order != "WAIVE" and order in ACTION_LIST]
@@ -107,8 +106,7 @@ def train_sl(dataset_path, model_path=None, print_ratio=0, save_ratio=1000, outp
 
                     last_phase_orders = orders
 
-                    dist, value_outputs = player.brain(torch.Tensor(board_state).to(device),
-                                                       torch.Tensor(prev_orders).to(device),
+                    dist, value_outputs = player.brain(torch.Tensor(state).to(device),
                                                        powers,
                                                        orderable_locs)
 
@@ -15,8 +15,8 @@ class StatTracker:
             self.score[power].append(
                 len(game.get_state()["centers"][power]))
 
-    def end_game(self):
-        final_score = {power: self.score[power][-1] for power in ALL_POWERS}
+    def end_game(self, game):
+        final_score = {power: len(game.get_state()["centers"][power]) for power in ALL_POWERS}
         self.wins[max(final_score, key=final_score.get)] += 1
 
     def plot_game(self):